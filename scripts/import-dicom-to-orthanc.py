@@ -5,25 +5,53 @@ This script reads the raw DICOM files and imports them into Orthanc database
 (stored in volumes-db/orthanc-data) via its REST API.
 """
 
+import argparse
+import io
 import os
 import json
+import mmap
+import zipfile
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Configuration
 ORTHANC_URL = "http://localhost:8042"
 SOURCE_PATH = Path("./volumes/orthanc-data")  # Raw DICOM files (source)
 METADATA_FILE = SOURCE_PATH / "dicom_metadata.json"
+MAX_WORKERS = 16  # Concurrent uploads
+PROGRESS_INTERVAL = 100  # Files between progress updates
+
+# Shared session so TCP connections are kept alive across uploads
+SESSION = requests.Session()
+
+def configure_session(pool_size):
+    """Size the connection pool of the shared session, to match the number of upload workers."""
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=3, backoff_factor=0.2),
+    )
+    SESSION.mount("http://", adapter)
+    SESSION.mount("https://", adapter)
+
+configure_session(MAX_WORKERS)
 
 def import_dicom_file(file_path):
     """Import a single DICOM file to Orthanc."""
     try:
-        with open(file_path, 'rb') as f:
-            response = requests.post(
+        # Memory-map the file so its content is paged in by the kernel as the
+        # socket drains, instead of being buffered in Python memory
+        with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            response = SESSION.post(
                 f"{ORTHANC_URL}/instances",
-                headers={'Content-Type': 'application/dicom'},
-                data=f
+                headers={
+                    'Content-Type': 'application/dicom',
+                    'Content-Length': str(len(mm))
+                },
+                data=mm
             )
         
         if response.status_code == 200:
@@ -33,17 +61,170 @@ def import_dicom_file(file_path):
     except Exception as e:
         return False, str(e)
 
+def import_dicom_archive(file_paths):
+    """Import a batch of DICOM files to Orthanc in a single request, as a ZIP archive.
+
+    Returns the number of successful imports, and an error message if the request failed.
+    """
+    try:
+        # DICOM files are stored without recompression; Orthanc unpacks the archive
+        archive_buffer = io.BytesIO()
+        with zipfile.ZipFile(archive_buffer, 'w', zipfile.ZIP_STORED) as archive:
+            for i, file_path in enumerate(file_paths):
+                archive.write(file_path, arcname=f"{i}.dcm")
+        archive_buffer.seek(0)
+        
+        response = SESSION.post(
+            f"{ORTHANC_URL}/instances",
+            headers={'Content-Type': 'application/zip'},
+            data=archive_buffer
+        )
+        
+        if response.status_code != 200:
+            return 0, f"HTTP {response.status_code}: {response.text}"
+        # Orthanc answers with one entry per instance it could import
+        instances = response.json()
+        return sum(1 for instance in instances if instance.get('Status') in ('Success', 'AlreadyStored')), None
+    except Exception as e:
+        return 0, str(e)
+
 def discover_dicom_files(source_path):
     """Discover all DICOM files in the source directory."""
+    # Walk the tree with os.scandir, which gets the entry type from the
+    # directory listing itself instead of an extra stat call per file
     dicom_files = []
-    for root, dirs, files in os.walk(source_path):
-        for file in files:
-            if file.endswith('.dcm'):
-                file_path = Path(root) / file
-                dicom_files.append({'filename': str(file_path.relative_to(source_path))})
+    pending_dirs = [source_path]
+    while pending_dirs:
+        with os.scandir(pending_dirs.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending_dirs.append(entry.path)
+                elif entry.name.endswith('.dcm') and entry.is_file():
+                    dicom_files.append({'filename': os.path.relpath(entry.path, source_path)})
     return dicom_files
 
-def main():
+def resolve_dicom_path(dicom_info):
+    """Resolve the source file path of a metadata entry, or None if it has no path."""
+    # Handle both 'filename' and 'dest_path' metadata formats
+    if 'filename' in dicom_info:
+        return SOURCE_PATH / dicom_info['filename']
+    if 'dest_path' not in dicom_info:
+        return None
+
+    dest_path = Path(dicom_info['dest_path'])
+    if not dest_path.is_absolute():
+        return SOURCE_PATH / dest_path
+
+    # If dest_path is absolute, try to make it relative to SOURCE_PATH
+    # by extracting the relative part after 'volumes/orthanc-data'
+    try:
+        # Find where 'volumes/orthanc-data' or 'orthanc-data' appears in the path
+        path_parts = dest_path.parts
+        if 'orthanc-data' in path_parts:
+            orthanc_idx = path_parts.index('orthanc-data')
+            relative_parts = path_parts[orthanc_idx + 1:]
+            return SOURCE_PATH / Path(*relative_parts)
+        # Fall back to using filename from path
+        return SOURCE_PATH / dest_path.name
+    except Exception as e:
+        print(f"⚠️  Could not convert absolute path, using filename: {e}")
+        return SOURCE_PATH / dest_path.name
+
+def resolve_paths(dicom_files):
+    """Resolve the file paths of the metadata entries.
+
+    Returns the list of file paths, and the number of entries without a path.
+    """
+    file_paths = []
+    invalid_entries = 0
+    for dicom_info in dicom_files:
+        file_path = resolve_dicom_path(dicom_info)
+        if file_path is None:
+            print(f"❌ No filename or dest_path in metadata entry: {dicom_info}")
+            invalid_entries += 1
+        else:
+            file_paths.append(file_path)
+    return file_paths, invalid_entries
+
+def filter_existing(file_paths):
+    """Keep the file paths that exist, listing each parent directory once instead of checking every file.
+
+    Returns the list of existing file paths, and the number of missing files.
+    """
+    files_by_dir = {}
+    for file_path in file_paths:
+        parent = file_path.parent
+        if parent not in files_by_dir:
+            try:
+                with os.scandir(parent) as entries:
+                    files_by_dir[parent] = {entry.name for entry in entries if entry.is_file()}
+            except OSError:
+                files_by_dir[parent] = set()
+
+    existing_paths = []
+    missing_files = 0
+    for file_path in file_paths:
+        if file_path.name in files_by_dir[file_path.parent]:
+            existing_paths.append(file_path)
+        else:
+            print(f"❌ File not found: {file_path}")
+            missing_files += 1
+    return existing_paths, missing_files
+
+def upload_all(file_paths, verbose=False, max_workers=MAX_WORKERS):
+    """Import the DICOM files to Orthanc concurrently.
+
+    Returns the number of successful and failed imports.
+    """
+    total_files = len(file_paths)
+    successful_imports = 0
+    failed_imports = 0
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(import_dicom_file, file_path): file_path for file_path in file_paths}
+        for i, future in enumerate(as_completed(futures), 1):
+            file_path = futures[future]
+            success, result = future.result()
+            if success:
+                successful_imports += 1
+                if verbose:
+                    print(f"✅ [{i}/{total_files}] Imported: {file_path.name}")
+            else:
+                failed_imports += 1
+                print(f"❌ [{i}/{total_files}] Import failed for {file_path.name}: {result}")
+            if not verbose and (i % PROGRESS_INTERVAL == 0 or i == total_files):
+                print(f"📤 Processed {i}/{total_files} files ({successful_imports} imported)")
+    
+    return successful_imports, failed_imports
+
+def upload_all_archives(file_paths, batch_size, max_workers=MAX_WORKERS):
+    """Import the DICOM files to Orthanc concurrently, as ZIP archives of `batch_size` files.
+
+    Returns the number of successful and failed imports.
+    """
+    total_files = len(file_paths)
+    successful_imports = 0
+    completed_files = 0
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(import_dicom_archive, file_paths[i:i + batch_size]): len(file_paths[i:i + batch_size])
+            for i in range(0, total_files, batch_size)
+        }
+        for future in as_completed(futures):
+            batch_files = futures[future]
+            successful, error = future.result()
+            successful_imports += successful
+            completed_files += batch_files
+            if error:
+                print(f"❌ Import of a {batch_files} files archive failed: {error}")
+            elif successful < batch_files:
+                print(f"❌ {batch_files - successful} of {batch_files} files in an archive could not be imported")
+            print(f"📤 Processed {completed_files}/{total_files} files ({successful_imports} imported)")
+    
+    return successful_imports, total_files - successful_imports
+
+def main(verbose=False, max_workers=MAX_WORKERS, zip_batch=1):
     print("🔄 Importing DICOM files to Orthanc...")
     print(f"📁 Source path: {SOURCE_PATH}")
     print(f"🌐 Orthanc URL: {ORTHANC_URL}")
@@ -68,55 +249,15 @@ def main():
     
     print(f"📊 Found {len(dicom_files)} DICOM files to import")
     
-    # Import each DICOM file
-    total_files = len(dicom_files)
-    successful_imports = 0
-    failed_imports = 0
-    
-    for i, dicom_info in enumerate(dicom_files, 1):
-        # Handle both 'filename' and 'dest_path' metadata formats
-        if 'filename' in dicom_info:
-            file_path = SOURCE_PATH / dicom_info['filename']
-        elif 'dest_path' in dicom_info:
-            dest_path = Path(dicom_info['dest_path'])
-            # If dest_path is absolute, try to make it relative to SOURCE_PATH
-            if dest_path.is_absolute():
-                # Extract the relative part after 'volumes/orthanc-data'
-                try:
-                    # Find where 'volumes/orthanc-data' or 'orthanc-data' appears in the path
-                    path_parts = dest_path.parts
-                    if 'orthanc-data' in path_parts:
-                        orthanc_idx = path_parts.index('orthanc-data')
-                        relative_parts = path_parts[orthanc_idx + 1:]
-                        file_path = SOURCE_PATH / Path(*relative_parts)
-                    else:
-                        # Fall back to using filename from path
-                        file_path = SOURCE_PATH / dest_path.name
-                except Exception as e:
-                    print(f"⚠️  Could not convert absolute path, using filename: {e}")
-                    file_path = SOURCE_PATH / dest_path.name
-            else:
-                file_path = SOURCE_PATH / dest_path
-        else:
-            print(f"❌ No filename or dest_path in metadata entry: {dicom_info}")
-            failed_imports += 1
-            continue
-            
-        print(f"📤 [{i}/{total_files}] Importing: {file_path.name}")
-        
-        if not file_path.exists():
-            print(f"❌ File not found: {file_path}")
-            failed_imports += 1
-            continue
-        
-        # Import the DICOM file
-        success, result = import_dicom_file(file_path)
-        if success:
-            successful_imports += 1
-            print(f"✅ Imported successfully")
-        else:
-            failed_imports += 1
-            print(f"❌ Import failed: {result}")
+    # Resolve, check, then upload the files, each in a separate pass
+    file_paths, failed_imports = resolve_paths(dicom_files)
+    file_paths, missing_files = filter_existing(file_paths)
+    configure_session(max_workers)
+    if zip_batch > 1:
+        successful_imports, failed_uploads = upload_all_archives(file_paths, zip_batch, max_workers)
+    else:
+        successful_imports, failed_uploads = upload_all(file_paths, verbose, max_workers)
+    failed_imports += missing_files + failed_uploads
     
     print(f"\n🎉 Import complete!")
     print(f"✅ Successful imports: {successful_imports}")
@@ -124,7 +265,7 @@ def main():
     
     # Check final status
     try:
-        response = requests.get(f"{ORTHANC_URL}/patients")
+        response = SESSION.get(f"{ORTHANC_URL}/patients")
         if response.status_code == 200:
             patients = response.json()
             print(f"👥 Total patients in Orthanc: {len(patients)}")
@@ -139,4 +280,9 @@ def main():
         print(f"⚠️  Could not check patient count: {e}")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-v', '--verbose', action='store_true', help="print a line for every imported file")
+    parser.add_argument('-w', '--workers', type=int, default=MAX_WORKERS, help=f"number of concurrent uploads (default: {MAX_WORKERS})")
+    parser.add_argument('-z', '--zip-batch', type=int, default=1, metavar='N', help="upload the files as ZIP archives of N files, one request per archive (requires Orthanc >= 1.8.2)")
+    args = parser.parse_args()
+    main(verbose=args.verbose, max_workers=args.workers, zip_batch=args.zip_batch)
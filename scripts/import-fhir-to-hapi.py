@@ -5,45 +5,161 @@ This script reads the raw FHIR JSON files and imports them into HAPI FHIR databa
 (stored in volumes-db/hapi-fhir-data) via its REST API.
 """
 
+import argparse
 import os
+import itertools
 import json
+import re
 import requests
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from pathlib import Path
-import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Configuration
 HAPI_FHIR_URL = "http://localhost:3000/hapi-fhir-jpaserver/fhir"
 SOURCE_PATH = Path("./volumes/hapi-fhir-data")  # Raw FHIR files (source)
+BUNDLE_SIZE = 200  # Resources per batch Bundle
+MAX_WORKERS = 12  # Concurrent Bundle imports
+# Resource types are imported in tiers, so that resources are only imported once
+# the resources they reference exist. Types not listed here are imported last.
+DEPENDENCY_TIERS = (
+    ("Organization", "Location", "Medication"),
+    ("Patient",),
+    ("Encounter",),
+)
 
-def import_fhir_resource(resource_json):
-    """Import a single FHIR resource to HAPI FHIR."""
-    try:
-        resource_type = resource_json.get('resourceType')
-        resource_id = resource_json.get('id')
+# Shared session so TCP connections are kept alive across requests
+SESSION = requests.Session()
+
+def configure_session(pool_size):
+    """Size the connection pool of the shared session, to match the number of import workers."""
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=3, backoff_factor=0.2),
+    )
+    SESSION.mount("http://", adapter)
+    SESSION.mount("https://", adapter)
+
+configure_session(MAX_WORKERS)
+
+def import_fhir_bundle(resources):
+    """Import a batch of FHIR resources to HAPI FHIR in a single batch Bundle.
+
+    Unlike a transaction, each entry of a batch succeeds or fails on its own, so an
+    invalid resource does not reject the rest of the Bundle.
+
+    Returns the number of successful and failed imports, and a list of error messages.
+    """
+    entries = []
+    errors = []
+    for resource in resources:
+        resource_type = resource.get('resourceType')
+        resource_id = resource.get('id')
         
         if not resource_type or not resource_id:
-            return False, "Missing resourceType or id"
+            errors.append("Missing resourceType or id")
+            continue
         
         # Use PUT to create/update with specific ID
-        url = f"{HAPI_FHIR_URL}/{resource_type}/{resource_id}"
-        
-        response = requests.put(
-            url,
+        entries.append({
+            'resource': resource,
+            'request': {'method': 'PUT', 'url': f"{resource_type}/{resource_id}"}
+        })
+    
+    if not entries:
+        return 0, len(errors), errors
+    
+    bundle = {'resourceType': 'Bundle', 'type': 'batch', 'entry': entries}
+    try:
+        response = SESSION.post(
+            HAPI_FHIR_URL,
             headers={
                 'Content-Type': 'application/fhir+json',
                 'Accept': 'application/fhir+json'
             },
-            json=resource_json
+            json=bundle
         )
-        
-        if response.status_code in [200, 201]:
-            return True, response.json()
-        else:
-            return False, f"HTTP {response.status_code}: {response.text}"
     except Exception as e:
-        return False, str(e)
+        return 0, len(resources), errors + [str(e)]
+    
+    # The whole batch is only rejected if the Bundle itself is invalid
+    if response.status_code != 200:
+        errors.append(f"HTTP {response.status_code}: {response.text}")
+        return 0, len(resources), errors
+    
+    successful = 0
+    for entry in response.json().get('entry', []):
+        status = entry.get('response', {}).get('status', '')
+        if status.startswith(('200', '201')):
+            successful += 1
+        else:
+            outcome = entry.get('response', {}).get('outcome', {})
+            diagnostics = '; '.join(issue.get('diagnostics', '') for issue in outcome.get('issue', []))
+            errors.append(f"Entry status: {status}" + (f" ({diagnostics})" if diagnostics else ""))
+    return successful, len(resources) - successful, errors
+
+def iter_json_array(file_path, read_size=1 << 20):
+    """Incrementally parse a JSON file containing an array, yielding one element at a time.
+
+    Only the elements currently being decoded are held in memory, instead of the whole array.
+    """
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r'\s*')
+    with open(file_path, 'r') as f:
+        buffer = f.read(read_size)
+        while buffer.isspace() and (chunk := f.read(read_size)):
+            buffer += chunk
+        pos = whitespace.match(buffer).end()
+        if buffer[pos:pos + 1] != '[':
+            raise ValueError(f"Expected a JSON array in {file_path}")
+        pos += 1
+        eof = False
+        # Either at the 'start' of the array, expecting an 'element' after a comma,
+        # or expecting the 'separator' after an element
+        state = 'start'
+        while True:
+            pos = whitespace.match(buffer, pos).end()
+            char = buffer[pos:pos + 1]
+            if state == 'separator':
+                # The separator is always buffered, see below
+                if char == ']':
+                    return
+                pos += 1
+                state = 'element'
+                continue
+            if char == ']' and state == 'start':
+                return
+            if char in (',', ']'):
+                raise ValueError(f"Unexpected '{char}' in the JSON array in {file_path}")
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+                # The element is only complete once its separator has been read,
+                # otherwise it may be truncated (e.g. a number)
+                next_pos = whitespace.match(buffer, end).end()
+                complete = buffer[next_pos:next_pos + 1] in (',', ']')
+            except json.JSONDecodeError:
+                complete = False
+            if complete:
+                yield item
+                pos = end
+                state = 'separator'
+                continue
+            if eof:
+                raise ValueError(f"Invalid or truncated JSON array in {file_path}")
+            chunk = f.read(read_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+def iter_chunks(items, size):
+    """Yield successive lists of at most `size` items."""
+    iterator = iter(items)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
 
-def main():
+def main(max_workers=MAX_WORKERS):
     print("🔄 Importing FHIR resources to HAPI FHIR server...")
     print(f"📁 Source path: {SOURCE_PATH}")
     print(f"🌐 HAPI FHIR URL: {HAPI_FHIR_URL}")
@@ -52,80 +168,85 @@ def main():
         print(f"❌ Source path not found: {SOURCE_PATH}")
         return
     
-    # Import patients first
+    # Collect the resource files, with the patients stored at the top level
+    resource_files = {}
     patients_file = SOURCE_PATH / "patients.json"
     if patients_file.exists():
-        print(f"📤 Importing patients from {patients_file.name}")
-        
-        with open(patients_file, 'r') as f:
-            patients = json.load(f)
-        
-        successful_patients = 0
-        failed_patients = 0
-        
-        for i, patient in enumerate(patients):
-            print(f"   📤 Importing patient {i+1}/{len(patients)}: {patient.get('id', 'Unknown ID')}")
-            
-            success, result = import_fhir_resource(patient)
-            
-            if success:
-                print(f"      ✅ Success")
-                successful_patients += 1
-            else:
-                print(f"      ❌ Failed: {result}")
-                failed_patients += 1
-            
-            time.sleep(0.1)  # Small delay
-        
-        print(f"👥 Patients: {successful_patients} successful, {failed_patients} failed")
+        resource_files["Patient"] = patients_file
+    for resource_dir in SOURCE_PATH.iterdir():
+        resource_file = resource_dir / f"{resource_dir.name}.json"
+        if resource_dir.is_dir() and resource_file.exists():
+            resource_files[resource_dir.name] = resource_file
+
+    tiers = [[t for t in tier if t in resource_files] for tier in DEPENDENCY_TIERS]
+    tiered_types = {t for tier in DEPENDENCY_TIERS for t in tier}
+    tiers.append(sorted(t for t in resource_files if t not in tiered_types))
     
-    # Import other resources
-    resource_dirs = [d for d in SOURCE_PATH.iterdir() if d.is_dir()]
+    successful_resources = {}
+    failed_resources = {}
+    shown_errors = {}
     
-    total_resources_saved = 0
-    total_resources_failed = 0
+    def record_result(future, resource_type):
+        successful, failed, errors = future.result()
+        successful_resources[resource_type] += successful
+        failed_resources[resource_type] += failed
+        for error in errors[:5 - shown_errors[resource_type]]:  # Show first 5 errors
+            print(f"      ❌ {resource_type} failed: {error}")
+        shown_errors[resource_type] = min(5, shown_errors[resource_type] + len(errors))
     
-    for resource_dir in resource_dirs:
-        resource_type = resource_dir.name
-        resource_file = resource_dir / f"{resource_type}.json"
-        
-        if not resource_file.exists():
-            continue
-        
-        print(f"\n📤 Importing {resource_type} from {resource_file.name}")
-        
-        with open(resource_file, 'r') as f:
-            resources = json.load(f)
-        
-        successful_resources = 0
-        failed_resources = 0
-        
-        for i, resource in enumerate(resources):
-            if i % 100 == 0:  # Progress every 100 resources
-                print(f"   📤 Importing {resource_type} {i+1}/{len(resources)}")
+    configure_session(max_workers)
+    aborted = False
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # The Bundles of a tier are imported concurrently, and each tier is
+        # complete before the next one starts
+        for tier in tiers:
+            futures = {}
+            for resource_type in tier:
+                resource_file = resource_files[resource_type]
+                print(f"📤 Importing {resource_type} from {resource_file.name}")
+                successful_resources[resource_type] = 0
+                failed_resources[resource_type] = 0
+                shown_errors[resource_type] = 0
+                
+                # Resources are parsed while earlier Bundles are being imported. The
+                # number of pending Bundles is bounded to keep memory usage constant.
+                parsed = 0
+                try:
+                    for chunk in iter_chunks(iter_json_array(resource_file), BUNDLE_SIZE):
+                        if len(futures) >= 2 * max_workers:
+                            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                            for future in done:
+                                record_result(future, futures.pop(future))
+                        futures[executor.submit(import_fhir_bundle, chunk)] = resource_type
+                        parsed += len(chunk)
+                except ValueError as e:
+                    # Bundles that were already submitted are still imported, but the
+                    # following resources and tiers are not
+                    print(f"❌ {resource_type} import aborted after {parsed} resources: {e}")
+                    aborted = True
+                    break
             
-            success, result = import_fhir_resource(resource)
-            
-            if success:
-                successful_resources += 1
-            else:
-                failed_resources += 1
-                if failed_resources <= 5:  # Show first 5 errors
-                    print(f"      ❌ Failed: {result}")
-            
-            time.sleep(0.01)  # Small delay
-        
-        print(f"   ✅ {resource_type}: {successful_resources} successful, {failed_resources} failed")
-        total_resources_saved += successful_resources
-        total_resources_failed += failed_resources
+            for future in as_completed(futures):
+                record_result(future, futures[future])
+            if aborted:
+                break
+    
+    print()
+    for resource_type in successful_resources:
+        print(f"   ✅ {resource_type}: {successful_resources[resource_type]} successful, {failed_resources[resource_type]} failed")
+    total_resources_saved = sum(successful_resources.values())
+    total_resources_failed = sum(failed_resources.values())
     
-    print(f"\n🎉 Import complete!")
+    if aborted:
+        print("\n⚠️  Import aborted because of an invalid resource file")
+    else:
+        print(f"\n🎉 Import complete!")
     print(f"✅ Total successful imports: {total_resources_saved}")
     print(f"❌ Total failed imports: {total_resources_failed}")
     
     # Check final status
     try:
-        response = requests.get(f"{HAPI_FHIR_URL}/Patient")
+        response = SESSION.get(f"{HAPI_FHIR_URL}/Patient")
         if response.status_code == 200:
             bundle = response.json()
             patient_count = bundle.get('total', 0)
@@ -136,4 +257,7 @@ def main():
         print(f"⚠️  Could not check patient count: {e}")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-w', '--workers', type=int, default=MAX_WORKERS, help=f"number of concurrent Bundle imports (default: {MAX_WORKERS})")
+    args = parser.parse_args()
+    main(max_workers=args.workers)
@@ -1,11 +1,41 @@
+import atexit
+import threading
 import torch
-from transformers import AutoModelForImageTextToText, AutoProcessor
+from transformers import AutoModelForImageTextToText, AutoProcessor, BitsAndBytesConfig, TextStreamer
 from PIL import Image
 import itk
 import numpy as np
 import os
+from typing import Callable
 from huggingface_hub import login
 
+# Release the cached GPU memory once, at process exit
+atexit.register(torch.cuda.empty_cache)
+
+MODEL_VARIANT = "4b-it"  # @param ["4b-it", "27b-it", "27b-text-it"]
+MODEL_ID = f"google/medgemma-{MODEL_VARIANT}"
+
+# Vital sign dictionary keys with their human-readable names and units
+VITAL_SIGNS = (
+    ("heart_rate", "Heart Rate", "bpm"),
+    ("respiratory_rate", "Respiratory Rate", "breaths/min"),
+    ("spo2", "SpO2", "%"),
+    ("systolic_bp", "Systolic Blood Pressure", "mmHg"),
+    ("diastolic_bp", "Diastolic Blood Pressure", "mmHg"),
+    ("mean_arterial_pressure", "Mean Arterial Pressure", "mmHg"),
+)
+
+class CallbackStreamer(TextStreamer):
+    """Streams the decoded text of a generation to a callback, as soon as whole words are available."""
+
+    def __init__(self, tokenizer, on_text: Callable[[str], None]):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.on_text = on_text
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        if text:
+            self.on_text(text)
+
 def setup_huggingface_auth():
     """Setup Hugging Face authentication using HF_TOKEN environment variable."""
     hf_token = os.getenv('HF_TOKEN')
@@ -31,6 +61,145 @@ def get_model_cache_dir(model_id: str) -> str:
     # Fallback to default cache directory
     return None
 
+def get_attn_implementation() -> str:
+    """Get the attention implementation to use, set by MEDGEMMA_ATTN_IMPLEMENTATION.
+
+    Defaults to PyTorch SDPA. FlashAttention-2 ("flash_attention_2") is opt-in, as
+    transformers does not apply Gemma 3's bidirectional attention mask over image
+    tokens with it, which changes the model's outputs.
+    """
+    return os.getenv("MEDGEMMA_ATTN_IMPLEMENTATION") or "sdpa"
+
+# Loaded (model, processor) pairs, keyed by model ID. Loading is guarded by a lock so
+# that concurrent first requests, e.g. during the startup preload, do not load the
+# same weights twice.
+_models = {}
+_models_lock = threading.Lock()
+
+def load_medgemma(model_id: str) -> tuple:
+    """
+    Loads a MedGemma model and its processor. The result is cached, so the weights are
+    only loaded once per process and stay resident across inference requests.
+
+    Args:
+        model_id (str): The Hugging Face model ID, e.g. "google/medgemma-4b-it".
+
+    Returns:
+        tuple: The loaded (model, processor) pair.
+    """
+    with _models_lock:
+        if model_id in _models:
+            return _models[model_id]
+
+        # Setup Hugging Face authentication
+        setup_huggingface_auth()
+
+        # Get cache directory for model storage
+        cache_dir = get_model_cache_dir(model_id)
+
+        print(f"Loading MedGemma model: {model_id}")
+        if cache_dir:
+            print(f"Using cache directory: {cache_dir}")
+
+        # Load model and processor with caching
+        model_kwargs = {
+            "device_map": "auto",
+            "torch_dtype": torch.bfloat16,
+            "attn_implementation": get_attn_implementation(),
+        }
+        processor_kwargs = {}
+
+        # Optional weight quantization, e.g. to fit the 27B variants on a single GPU
+        quantization = os.getenv("MEDGEMMA_QUANTIZATION")
+        if quantization == "4bit":
+            model_kwargs["quantization_config"] = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=torch.bfloat16,
+            )
+        elif quantization == "8bit":
+            # LLM.int8() weights, with the vision tower kept in bfloat16
+            model_kwargs["quantization_config"] = BitsAndBytesConfig(
+                load_in_8bit=True,
+                llm_int8_skip_modules=["vision_tower", "multi_modal_projector", "lm_head"],
+            )
+        elif quantization:
+            raise ValueError(f"Unsupported MEDGEMMA_QUANTIZATION value: '{quantization}'. Supported values: 4bit, 8bit")
+
+        if cache_dir:
+            model_kwargs["cache_dir"] = cache_dir
+            processor_kwargs["cache_dir"] = cache_dir
+
+        model = AutoModelForImageTextToText.from_pretrained(model_id, **model_kwargs)
+        processor = AutoProcessor.from_pretrained(model_id, **processor_kwargs)
+
+        # Optionally specialize the forward pass with torch.compile. Compilation happens
+        # lazily on the first generation, and is then reused thanks to the model cache.
+        # The KV cache must keep the decode step shapes fixed, so that the forward
+        # pass is not recompiled (and its CUDA graphs re-recorded) at every step.
+        # Gemma 3 checkpoints ship a fixed-shape hybrid cache; a static cache is only
+        # used for checkpoints that do not configure one.
+        if os.getenv("MEDGEMMA_TORCH_COMPILE") == "1":
+            if not getattr(model.generation_config, "cache_implementation", None):
+                model.generation_config.cache_implementation = "static"
+            model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False)
+
+        _models[model_id] = (model, processor)
+        return model, processor
+
+def preload_medgemma() -> None:
+    """Loads the MedGemma model used for inference, so that the first request does not pay for it."""
+    load_medgemma(MODEL_ID)
+
+def normalize_to_uint8(img_array: np.ndarray) -> np.ndarray:
+    """
+    Linearly rescales an image array to the full 8-bit range [0, 255].
+
+    The rescaling is done in a single float32 buffer with in-place operations, to avoid
+    allocating a temporary array per arithmetic operation on large images.
+
+    Args:
+        img_array (np.ndarray): The input image array, of any numeric dtype.
+
+    Returns:
+        np.ndarray: The rescaled uint8 image array.
+    """
+    # The range is computed in float64, as it can overflow the image's own dtype
+    mn, mx = float(img_array.min()), float(img_array.max())
+    scale = np.float32(255.0 / (mx - mn)) if mx > mn else np.float32(0)
+    out = np.empty(img_array.shape, dtype=np.float32)
+    np.subtract(img_array, mn, out=out, dtype=np.float32)
+    out *= scale
+    # Round rather than truncate, so that the float32 scale still maps the maximum to 255
+    np.rint(out, out=out)
+    return out.astype(np.uint8, copy=False)
+
+def downsample_to_processor_size(image_uint8: np.ndarray, processor) -> np.ndarray:
+    """
+    Downsamples an 8-bit image to the input size of the processor, if it is larger.
+
+    Resizing once with area averaging up front means the processor only handles an
+    image of its target size, instead of resampling a full-resolution radiograph.
+
+    Args:
+        image_uint8 (np.ndarray): The (H, W) or (H, W, C) uint8 image array.
+        processor: The model processor, whose image processor defines the target size.
+
+    Returns:
+        np.ndarray: The downsampled image array, or the input array if no resize is needed.
+    """
+    size = getattr(processor.image_processor, "size", None) or {}
+    target_width, target_height = size.get("width"), size.get("height")
+    if target_width is None or target_height is None:
+        return image_uint8
+
+    height, width = image_uint8.shape[:2]
+    if width <= target_width or height <= target_height:
+        return image_uint8
+
+    image = Image.fromarray(image_uint8).resize((target_width, target_height), resample=Image.Resampling.BOX)
+    return np.asarray(image)
+
 def generate_vital_sign_summary_prompt(vital_signs_data: dict) -> str:
     """
     Parses a dictionary of vital sign measurements and generates a natural language
@@ -46,33 +215,16 @@ def generate_vital_sign_summary_prompt(vital_signs_data: dict) -> str:
     Returns:
         str: A natural language string summarizing the most recent vital signs
     """
-    summary_parts = []
-
-    # Define a mapping from dictionary keys to human-readable names and units
-    vital_sign_map = {
-        "heart_rate": {"name": "Heart Rate", "unit": "bpm"},
-        "respiratory_rate": {"name": "Respiratory Rate", "unit": "breaths/min"},
-        "spo2": {"name": "SpO2", "unit": "%"},
-        "systolic_bp": {"name": "Systolic Blood Pressure", "unit": "mmHg"},
-        "diastolic_bp": {"name": "Diastolic Blood Pressure", "unit": "mmHg"},
-        "mean_arterial_pressure": {"name": "Mean Arterial Pressure", "unit": "mmHg"},
-    }
-
-    # Extract the most recent measurement for each vital sign
-    for key, info in vital_sign_map.items():
-        if key in vital_signs_data and vital_signs_data[key]:
-            # The most recent measurement is the last element in the list
-            most_recent_value = vital_signs_data[key][-1]
-            summary_parts.append(f"{info['name']}: {most_recent_value} {info['unit']}")
-        else:
-            summary_parts.append(f"{info['name']}: Not available")
-
-    # Combine the vital sign summaries
-    vital_signs_summary = ", ".join(summary_parts)
-
-    return vital_signs_summary
-
-def run_volview_insight_medgemma_inference(input_data: dict, itk_img: itk.image = None) -> str:
+    # Combine the summaries of the most recent measurement of each vital sign.
+    # The most recent measurement is the last element in the list.
+    return ", ".join(
+        f"{name}: {vital_signs_data[key][-1]} {unit}" if vital_signs_data.get(key) else f"{name}: Not available"
+        for key, name, unit in VITAL_SIGNS
+    )
+
+def run_volview_insight_medgemma_inference(
+    input_data: dict, itk_img: itk.image = None, on_text: Callable[[str], None] = None
+) -> str:
     """
     Runs inference using the MedGemma 27B - Multimodal model. It can process either text-only prompts (not preferred)
     or prompts combined with an ITK image and vital signs data.
@@ -87,16 +239,15 @@ def run_volview_insight_medgemma_inference(input_data: dict, itk_img: itk.image
         itk_img (itk.image, optional): An ITK image object. If provided, the image
                                        will be processed along with the vital signs data
                                        and the prompt. Defaults to None.
+        on_text (Callable[[str], None], optional): Called with each chunk of the response
+                                       as it is generated. Defaults to None.
 
     Returns:
         str: The generated text response from the MedGemma model.
     """
 
-    # Setup Hugging Face authentication
-    setup_huggingface_auth()
-
-    model_variant = "4b-it"  # @param ["4b-it", "27b-it", "27b-text-it"]
-    model_id = f"google/medgemma-{model_variant}"
+    model_variant = MODEL_VARIANT
+    model_id = MODEL_ID
     is_thinking = False
 
     role_instruction = "You are an expert radiologist."
@@ -112,18 +263,26 @@ def run_volview_insight_medgemma_inference(input_data: dict, itk_img: itk.image
     user_question = input_data['prompt']
     vital_signs_summary = generate_vital_sign_summary_prompt(input_data)
 
+    model, processor = load_medgemma(model_id)
+    images = None
+
     if itk_img is not None:
 
         # Load image 
-        img_array = itk.array_from_image(itk_img).astype(int).squeeze()
+        img_array = itk.array_view_from_image(itk_img).squeeze()
         print('Input image array shape:', img_array.shape)
-        image_uint8 = (255 * (img_array - img_array.min()) / (img_array.max() - img_array.min())).astype(np.uint8)
-        image = Image.fromarray(image_uint8)
+        image_uint8 = downsample_to_processor_size(normalize_to_uint8(img_array), processor)
+        if image_uint8.ndim == 2:
+            # Build the 3-channel image the model expects directly, rather than
+            # having the processor convert a grayscale PIL image to RGB
+            image_uint8 = np.ascontiguousarray(np.broadcast_to(image_uint8[..., None], image_uint8.shape + (3,)))
+        # The image processor accepts arrays, so the image is not copied into a PIL image
+        images = [image_uint8]
 
         prompt = f"Analyze the provided chest X-ray and the patient's most recent vital signs: {vital_signs_summary}. Based on this data, answer the following question: {user_question}"  
         content = [
                     {"type": "text", "text": prompt},
-                    {"type": "image", "image": image}
+                    {"type": "image"}
                 ]
     
     else:
@@ -144,37 +303,14 @@ def run_volview_insight_medgemma_inference(input_data: dict, itk_img: itk.image
         }
     ]
 
-    model_id = f"google/medgemma-{model_variant}"
-    
-    # Get cache directory for model storage
-    cache_dir = get_model_cache_dir(model_id)
-    
-    print(f"Loading MedGemma model: {model_id}")
-    if cache_dir:
-        print(f"Using cache directory: {cache_dir}")
-    
-    # Load model and processor with caching
-    model_kwargs = {
-        "device_map": "auto",
-        "torch_dtype": torch.bfloat16,
-    }
-    processor_kwargs = {}
-    
-    if cache_dir:
-        model_kwargs["cache_dir"] = cache_dir
-        processor_kwargs["cache_dir"] = cache_dir
-    
-    model = AutoModelForImageTextToText.from_pretrained(model_id, **model_kwargs)
-    processor = AutoProcessor.from_pretrained(model_id, **processor_kwargs)
-
     # --- Start of per-request logic ---
     
-    # Process inputs for the model
-    inputs = processor.apply_chat_template(
-        messages,
-        add_generation_prompt=True,
-        tokenize=True,
-        return_dict=True,
+    # Process inputs for the model. The chat template already includes the BOS token.
+    chat_prompt = processor.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
+    inputs = processor(
+        text=chat_prompt,
+        images=images,
+        add_special_tokens=False,
         return_tensors="pt",
     ).to(model.device, dtype=torch.bfloat16)
 
@@ -182,17 +318,14 @@ def run_volview_insight_medgemma_inference(input_data: dict, itk_img: itk.image
 
     # Run inference in a memory-efficient context
     with torch.inference_mode():
-        generation = model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False)
+        streamer = CallbackStreamer(processor.tokenizer, on_text) if on_text is not None else None
+        generation = model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False, streamer=streamer)
         generation = generation[0][input_len:]
 
     # Decode the generated tokens into a string response
     response = processor.decode(generation, skip_special_tokens=True)
 
-    # --- Memory Cleanup ---
-    # This is the critical step to prevent CUDA memory errors on subsequent runs.
-    # It explicitly deletes the large tensors from GPU memory.
-    del inputs
-    del generation
-    torch.cuda.empty_cache()
-
+    # The request tensors are released when they go out of scope. The CUDA caching
+    # allocator keeps their memory for the next request, so the cache is not emptied
+    # here: doing so synchronizes the GPU on every request.
     return response
@@ -1,20 +1,20 @@
 import asyncio
-from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor
 from dataclasses import dataclass, field
 import os
-from typing import Any, Dict
+from typing import Any, Callable, Dict, List
 
 import itk
 import numpy as np
-from sklearn.linear_model import LinearRegression
 
-from volview_insight_seg_inference import run_volview_insight_seg_inference
-from volview_insight_medgemma_inference import run_volview_insight_medgemma_inference
-from volview_server import VolViewApi, get_current_client_store, get_current_session
-from volview_server.transformers import (
-    convert_itk_to_vtkjs_image,
-    convert_vtkjs_to_itk_image,
+from volview_insight_seg_inference import preload_seg_model, run_volview_insight_seg_inference_arrays
+from volview_insight_medgemma_inference import (
+    VITAL_SIGNS,
+    preload_medgemma,
+    run_volview_insight_medgemma_inference,
 )
+from volview_server import VolViewApi, get_current_client_store, get_current_session
 
 ## Link to app ##
 
@@ -26,13 +26,75 @@ volview = VolViewApi()
 # copied from
 # https://github.com/Kitware/VolView/blob/411e5a891bfb520647ab3f97cac6edfcca930a65/server/examples/example_api.py
 
-process_pool = ProcessPoolExecutor(4)
+def find_seg_model_path() -> str | None:
+    """Returns the lung segmentation checkpoint path, or None if it is not installed."""
+    # Try volume-mounted path first, then fallback to local path
+    for model_path in ('/app/models/segmentLungsModel-v1.0.ckpt', './segmentLungsModel-v1.0.ckpt'):
+        if os.path.exists(model_path):
+            return model_path
+    return None
+
+
+SEG_MODEL_PATH = find_seg_model_path()
+if SEG_MODEL_PATH is None:
+    print("Lung segmentation model not found, segmentation requests will fail.")
+
+
+def _safe_preload(name: str, preload: Callable, *args) -> None:
+    """Preloads a model as a worker thread initializer, logging any failure.
+
+    An initializer error would break the executor, so a failed preload is left to be
+    retried by the first request instead.
+    """
+    try:
+        preload(*args)
+    except Exception as e:
+        print(f"Failed to preload the {name} model: {e}")
+
+
+# Each model runs on its own long-lived worker threads, so that its weights are
+# loaded once and stay resident across requests. The inference libraries
+# release the GIL during the forward pass, so this does not block the server.
+# The thread counts can be raised on hardware with room for concurrent requests.
+MEDGEMMA_WORKER_THREADS = int(os.getenv("MEDGEMMA_WORKER_THREADS") or 1)
+SEGMENTATION_WORKER_THREADS = int(os.getenv("SEGMENTATION_WORKER_THREADS") or 1)
+# The MedGemma threads share one model, and the CUDA graphs of its compiled
+# forward pass cannot be replayed by concurrent generations
+if MEDGEMMA_WORKER_THREADS > 1 and os.getenv("MEDGEMMA_TORCH_COMPILE") == "1":
+    raise ValueError("MEDGEMMA_WORKER_THREADS must be 1 when MEDGEMMA_TORCH_COMPILE is enabled")
+
+INFERENCE_EXECUTORS = {
+    "medgemma": ThreadPoolExecutor(
+        max_workers=MEDGEMMA_WORKER_THREADS,
+        thread_name_prefix="medgemma",
+        initializer=_safe_preload,
+        initargs=("MedGemma", preload_medgemma),
+    ),
+    "segmentation": ThreadPoolExecutor(
+        max_workers=SEGMENTATION_WORKER_THREADS,
+        thread_name_prefix="segmentation",
+        initializer=_safe_preload if SEG_MODEL_PATH is not None else None,
+        initargs=("lung segmentation", preload_seg_model, SEG_MODEL_PATH),
+    ),
+}
+
+# Start the worker threads right away, so that the models are loaded while the
+# server starts rather than on the first request
+if (os.getenv("PRELOAD_MODELS") or "1") == "1":
+    for executor in INFERENCE_EXECUTORS.values():
+        executor.submit(lambda: None)
+
+
+# Number of prepared image slices kept per client session
+SLICE_CACHE_SIZE = 8
 
 
 @dataclass
 class ClientState:
-    image_id_map: dict = field(init=False, default_factory=dict)
-    blurred_ids: set = field(init=False, default_factory=set)
+    base_to_seg: dict = field(init=False, default_factory=dict)
+    seg_to_base: dict = field(init=False, default_factory=dict)
+    # (image ID, layer) -> (image metadata, 2D slice), in least recently used order
+    slice_cache: OrderedDict = field(init=False, default_factory=OrderedDict)
 
 
 def associate_images(state: ClientState, image_id: str, blurred_id: str) -> None:
@@ -43,9 +105,48 @@ def associate_images(state: ClientState, image_id: str, blurred_id: str) -> None
         image_id: The ID of the original image.
         blurred_id: The ID of the blurred image.
     """
-    state.blurred_ids.add(blurred_id)
-    state.image_id_map[image_id] = blurred_id
-    state.image_id_map[blurred_id] = image_id
+    state.base_to_seg[image_id] = blurred_id
+    state.seg_to_base[blurred_id] = image_id
+
+
+def get_cached_slice(state: ClientState, image_id: str, active_layer: int | None, metadata: Any) -> itk.Image:
+    """Returns the cached slice of an image, or None if it is not cached or is stale.
+
+    Args:
+        state: The current client state object.
+        image_id: The ID of the image.
+        active_layer: The index of the 2D slice.
+        metadata: The image's current metadata on the client. A cached slice is only
+            used if it was taken from an image with the same metadata.
+    """
+    key = (image_id, active_layer)
+    entry = state.slice_cache.get(key)
+    if entry is None:
+        return None
+    cached_metadata, img_slice = entry
+    if metadata is None or cached_metadata != metadata:
+        del state.slice_cache[key]
+        return None
+    state.slice_cache.move_to_end(key)
+    return img_slice
+
+
+def cache_slice(
+    state: ClientState, image_id: str, active_layer: int | None, metadata: Any, img_slice: itk.Image
+) -> None:
+    """Caches a slice of an image, evicting the least recently used one when full.
+
+    Args:
+        state: The current client state object.
+        image_id: The ID of the image.
+        active_layer: The index of the 2D slice.
+        metadata: The image's metadata on the client, used to detect stale entries.
+        img_slice: The slice. It is copied so it does not keep the whole volume alive.
+    """
+    state.slice_cache[(image_id, active_layer)] = (metadata, itk.image_duplicator(img_slice))
+    state.slice_cache.move_to_end((image_id, active_layer))
+    while len(state.slice_cache) > SLICE_CACHE_SIZE:
+        state.slice_cache.popitem(last=False)
 
 
 def get_base_image(state: ClientState, img_id: str) -> str:
@@ -58,9 +159,7 @@ def get_base_image(state: ClientState, img_id: str) -> str:
     Returns:
         The ID of the original image.
     """
-    if img_id in state.blurred_ids:
-        return state.image_id_map[img_id]
-    return img_id
+    return state.seg_to_base.get(img_id, img_id)
 
 
 async def show_image(img_id: str) -> None:
@@ -80,36 +179,52 @@ def get_image_slice(img: itk.Image, active_layer: int | None = None) -> itk.Imag
         img: The ITK image object.
         active_layer: The index of the 2D slice to process. If None, assumes 2D image.
     """
-    # Check if the image is 3D and slicing is needed
+    # 2D images need no slicing
     dimension = img.GetImageDimension()
+    if dimension == 2:
+        return img
+    if dimension != 3:
+        raise RuntimeError("Input image has an invalid dimension")
 
     if active_layer is None:
         active_layer = 0
-        
-    if dimension == 2:
-        slice_2d = img
-    elif dimension == 3:
-        # Set up extraction filter
-        extract_filter = itk.ExtractImageFilter.New(img)
-        extract_filter.SetDirectionCollapseToSubmatrix()
-
-        # Define the extraction region
-        input_region = img.GetBufferedRegion()
-        size = input_region.GetSize()
-        size[2] = 1  # Only one slice in Z
-        start = input_region.GetIndex()
-        start[2] = active_layer
-        desired_region = input_region
-        desired_region.SetSize(size)
-        desired_region.SetIndex(start)
-
-        extract_filter.SetExtractionRegion(desired_region)
-        extract_filter.Update()
-        slice_2d = extract_filter.GetOutput()
-    else:
-        raise RuntimeError("Input image has an invalid dimension")
-    
-    return slice_2d
+
+    input_region = img.GetBufferedRegion()
+    first_layer = input_region.GetIndex()[2]
+    last_layer = first_layer + input_region.GetSize()[2] - 1
+    if not first_layer <= active_layer <= last_layer:
+        raise ValueError(
+            f"Layer index {active_layer} is out of range for an image with layers {first_layer} to {last_layer}"
+        )
+    start = list(input_region.GetIndex())
+    start[2] = active_layer
+
+    if img.GetNumberOfComponentsPerPixel() == 1:
+        # Take the slice as a view of the volume's buffer, keeping a single-slice
+        # 3D image like the extraction filter below
+        offset = active_layer - first_layer
+        slice_array = np.ascontiguousarray(itk.array_view_from_image(img)[offset:offset + 1])
+        slice_2d = itk.image_view_from_array(slice_array)
+        slice_2d.SetOrigin(img.TransformIndexToPhysicalPoint(start))
+        slice_2d.SetSpacing(img.GetSpacing())
+        slice_2d.SetDirection(img.GetDirection())
+        return slice_2d
+
+    # Set up extraction filter
+    extract_filter = itk.ExtractImageFilter.New(img)
+    extract_filter.SetDirectionCollapseToSubmatrix()
+
+    # Define the extraction region, on a new region object rather than the
+    # image's own buffered region
+    size = list(input_region.GetSize())
+    size[2] = 1  # Only one slice in Z
+    desired_region = itk.ImageRegion[3]()
+    desired_region.SetSize(size)
+    desired_region.SetIndex(start)
+
+    extract_filter.SetExtractionRegion(desired_region)
+    extract_filter.Update()
+    return extract_filter.GetOutput()
 
 @volview.expose("exampleAnalysis")
 async def example_analysis(patient_id: str) -> None:
@@ -129,39 +244,65 @@ async def example_analysis(patient_id: str) -> None:
     analysis_input = await store.analysisInput[patient_id]
     print(f"Got the input... ({analysis_input})")
 
-    points = np.array(analysis_input)
-    x = points[:, 0].reshape(-1, 1)
+    # Closed-form univariate least squares
+    points = np.asarray(analysis_input, dtype=float)
+    x = points[:, 0]
     y = points[:, 1]
-    model = LinearRegression()
-    model.fit(x, y)
-
-    slope = model.coef_[0]
-    intercept = model.intercept_
-    r_squared = model.score(x, y)
+    x_mean, y_mean = x.mean(), y.mean()
+    dx = x - x_mean
+    dy = y - y_mean
+    ss_x = dx @ dx
+    slope = (dx @ dy) / ss_x if ss_x else 0.0
+    intercept = y_mean - slope * x_mean
+
+    ss_res = np.square(dy - slope * dx).sum()
+    ss_tot = dy @ dy
+    # Same convention as sklearn's score for a constant target
+    r_squared = 1 - ss_res / ss_tot if ss_tot else float(ss_res == 0)
+    slope, intercept, r_squared = float(slope), float(intercept), float(r_squared)
 
     await store.setAnalysisResult(patient_id, [slope, intercept, r_squared])
 
     print(f"Example analysis finished and got result [{slope}, {intercept}, {r_squared}]")
 
-def do_medgemma_inference(serialized_img: Dict[str, Any], analysis_input: Dict ) -> str:
+def compact_analysis_input(analysis_input: Dict) -> Dict:
+    """Keeps only what the prompts use from the analysis input: the user prompt and
+    the most recent measurement of each vital sign, instead of the full time series.
+
+    Args:
+        analysis_input: Dictionary containing the user query and parsed FHIR resource data
+
+    Returns:
+        The compacted dictionary, in the same format.
+    """
+    vital_sign_keys = {key for key, _, _ in VITAL_SIGNS}
+    compact = {key: value for key, value in analysis_input.items() if key not in vital_sign_keys}
+    for key, _, _ in VITAL_SIGNS:
+        measurements = analysis_input.get(key)
+        if measurements:
+            compact[key] = measurements[-1:]
+    return compact
+
+def do_medgemma_inference(itk_img: itk.Image, analysis_input: Dict, on_text: Callable[[str], None] | None = None) -> str:
     """Runs medGemma inference
 
     Args:
-        serialized_img: The serialized ITK image (vtkjs format).
+        itk_img: The ITK image, or None for a text-only prompt.
         analysis input: Dictionary containing the user query and parsed FHIR resource data
+        on_text: Called from the worker thread with each chunk of the response as it is generated.
 
     Returns:
         The serialized text
 
     """
-    itk_img = convert_vtkjs_to_itk_image(serialized_img)
-    medgemma_response = run_volview_insight_medgemma_inference(input_data = analysis_input, itk_img = itk_img)
+    medgemma_response = run_volview_insight_medgemma_inference(input_data = analysis_input, itk_img = itk_img, on_text = on_text)
 
     return medgemma_response
 
 INFERENCE_DISPATCH = {
     "medgemma": do_medgemma_inference,
 }
+AVAILABLE_MODELS = ", ".join(INFERENCE_DISPATCH)
 
 
 @volview.expose("multimodalLlmAnalysis")
@@ -177,39 +318,70 @@ async def multimodal_llm_analysis(patient_id: str, img_id: str | None = None, ac
         active_layer: The index of the 2D slice to process. If None, assumes 2D image.
     """
     backend_store = get_current_client_store("backend-model-store")
-    selected_model = await backend_store.selectedModel
+    # --- 1. Get the selected model, user prompt and vital signs data ---
+    # Both are fetched from the client concurrently.
+    selected_model, analysis_input = await asyncio.gather(
+        backend_store.selectedModel, backend_store.analysisInput[patient_id]
+    )
     print(f"Starting multimodal LLM analysis with model: {selected_model}...")
-
-    # --- 1. Get user prompt and vital signs data ---
-    print("Got the backend model store. Fetching the analysis input dictionary...")
-    analysis_input_dict = await backend_store.analysisInput[patient_id]
+    analysis_input_dict = compact_analysis_input(analysis_input)
     print(f"Got analysis input: {analysis_input_dict}")
 
     # --- 2. Get the appropriate inference function from the dispatch table ---
     inference_function = INFERENCE_DISPATCH.get(selected_model)
     if not inference_function:
-        raise ValueError(f"Unknown model specified: '{selected_model}'. Available models: {list(INFERENCE_DISPATCH.keys())}")
+        raise ValueError(f"Unknown model specified: '{selected_model}'. Available models: {AVAILABLE_MODELS}")
 
     # --- 3. Get and process the image, if provided ---
-    serialized_img_vtkjs = None
+    img_slice = None
     if img_id is not None:
-        image_store = get_current_client_store("images")
-        print("Got the images store. Fetching the image from the client...")
         state = get_current_session(default_factory=ClientState)
         base_image_id = get_base_image(state, img_id)
-        img = await image_store.dataIndex[base_image_id]
-        print("Got the image data from the client. Starting image processing.")
-        img_slice = get_image_slice(img, active_layer)
-        serialized_img_vtkjs = convert_itk_to_vtkjs_image(img_slice)
+        image_store = get_current_client_store("images")
+        # Reuse the slice of a previous request on the same image, which skips
+        # fetching the whole volume from the client again. The image's metadata
+        # is much smaller than its data, and guards against stale entries.
+        metadata = await image_store.metadata[base_image_id]
+        img_slice = get_cached_slice(state, base_image_id, active_layer, metadata)
+        if img_slice is None:
+            print("Got the images store. Fetching the image from the client...")
+            img = await image_store.dataIndex[base_image_id]
+            print("Got the image data from the client. Starting image processing.")
+            # The inference runs on a thread of this process, so the image is handed
+            # over directly instead of being serialized.
+            img_slice = get_image_slice(img, active_layer)
+            cache_slice(state, base_image_id, active_layer, metadata, img_slice)
+        else:
+            print("Using the cached image slice.")
     else:
         print(f"Analysis with {selected_model} did not get an image ID. Will proceed without image.")
 
     # --- 4. Execute the selected model's inference logic ---
-    loop = asyncio.get_event_loop()
+    # The response is streamed to the client as it is generated, and then set
+    # in full once the generation is done.
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+
+    def on_text(text: str) -> None:
+        loop.call_soon_threadsafe(chunks.put_nowait, text)
+
     try:
-        model_response = await loop.run_in_executor(
-            process_pool, inference_function, serialized_img_vtkjs, analysis_input_dict
-        )
+        # The client clears the previous result before calling, so chunks are
+        # appended to an empty response
+        streaming = asyncio.create_task(stream_analysis_result(backend_store, patient_id, chunks))
+        try:
+            model_response = await loop.run_in_executor(
+                INFERENCE_EXECUTORS[selected_model], inference_function, img_slice, analysis_input_dict, on_text
+            )
+        finally:
+            # Chunks from the worker are queued before its result is delivered,
+            # so the sentinel comes after the last one
+            chunks.put_nowait(None)
+            try:
+                await streaming
+            except Exception as e:
+                # The full response is still set below, so a failed partial update is not fatal
+                print(f"Streaming the {selected_model} response failed: {e}")
         await backend_store.setAnalysisResult(patient_id, model_response)
         
         # Restore the final, detailed response log
@@ -220,37 +392,146 @@ async def multimodal_llm_analysis(patient_id: str, img_id: str | None = None, ac
             f"Unexpected error during {selected_model} inference: {e}"
         ) from e
 
-def do_lung_segmentation(serialized_img: Dict[str, Any]) -> Dict[str, Any]:
-    """Performs lung segmentation on a serialized image using a pre-trained model.
+async def stream_analysis_result(backend_store, patient_id: str, chunks: asyncio.Queue) -> None:
+    """Appends streamed response chunks to the client's analysis result, in order,
+    until a None sentinel is received.
+
+    Chunks that arrive while a previous one is being sent are combined, so that a
+    slow client connection does not fall behind the generation.
 
     Args:
-        serialized_img: The serialized ITK image (vtkjs format).
+        backend_store: The client's backend model store.
+        patient_id: The ID of the patient.
+        chunks: The queue of response chunks.
+    """
+    done = False
+    while not done:
+        parts = [await chunks.get()]
+        while not chunks.empty():
+            parts.append(chunks.get_nowait())
+        if None in parts:
+            done = True
+            parts = parts[:parts.index(None)]
+        if parts:
+            await backend_store.appendAnalysisResult(patient_id, "".join(parts))
+
+def do_lung_segmentation_batch(arrays: List[np.ndarray]) -> List[np.ndarray]:
+    """Performs lung segmentation on a batch of pixel arrays using a pre-trained model.
+
+    Args:
+        arrays: The pixel arrays of the 2D slices.
 
     Returns:
-        The serialized output segmentation image.
+        The output label arrays, in the same order.
 
     Raises:
         FileNotFoundError: If the segmentation model file is not found.
     """
-    # Try volume-mounted path first, then fallback to local path
-    model_path = '/app/models/segmentLungsModel-v1.0.ckpt'
-    if not os.path.exists(model_path):
-        model_path = './segmentLungsModel-v1.0.ckpt'
-
-    if not os.path.exists(model_path):
+    if SEG_MODEL_PATH is None:
         raise FileNotFoundError(
-            f"Model file not found at '{model_path}'. "
+            "Model file not found at '/app/models/segmentLungsModel-v1.0.ckpt' or './segmentLungsModel-v1.0.ckpt'. "
             "Please ensure that the model has been downloaded and placed in the correct location. "
             "Refer to the README for instructions on obtaining and installing the model."
         )
 
-    itk_img = convert_vtkjs_to_itk_image(serialized_img)
-    seg = run_volview_insight_seg_inference(itk_img, model_path)
-    return convert_itk_to_vtkjs_image(seg)
+    return run_volview_insight_seg_inference_arrays(arrays, SEG_MODEL_PATH)
+
+
+class MicroBatcher:
+    """Coalesces concurrent inference requests into batches.
+
+    Requests submitted within `max_wait_ms` of the first pending request, up to
+    `max_batch_size` of them, are run together with a single call of
+    `batch_function` on `executor`. Up to `max_concurrent_batches` batches run
+    at once; while they are all busy, new requests keep accumulating.
+    """
+
+    def __init__(
+        self,
+        batch_function: Callable[[List[Any]], List[Any]],
+        executor: Executor,
+        max_batch_size: int = 8,
+        max_wait_ms: float = 20,
+        max_concurrent_batches: int = 1,
+    ):
+        self.batch_function = batch_function
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_concurrent_batches = max_concurrent_batches
+        self._queue = None
+        self._consumer = None
+        self._slots = None
+        self._running = set()
+
+    async def submit(self, item: Any) -> Any:
+        """Queues an item for the next batch and waits for its result."""
+        if self._consumer is None:
+            self._queue = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self.max_concurrent_batches)
+            self._consumer = asyncio.create_task(self._consume())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _consume(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._slots.acquire()
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            task = asyncio.create_task(self._run_batch(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run_batch(self, batch: list) -> None:
+        loop = asyncio.get_running_loop()
+        items = [item for item, _ in batch]
+        try:
+            try:
+                results = await loop.run_in_executor(self.executor, self.batch_function, items)
+            except Exception as e:
+                if len(batch) == 1:
+                    if not batch[0][1].done():
+                        batch[0][1].set_exception(e)
+                    return
+                # Run the items one at a time, so that a single bad input only
+                # fails its own request
+                for item, future in batch:
+                    try:
+                        (result,) = await loop.run_in_executor(self.executor, self.batch_function, [item])
+                    except Exception as item_error:
+                        if not future.done():
+                            future.set_exception(item_error)
+                    else:
+                        if not future.done():
+                            future.set_result(result)
+                return
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self._slots.release()
+
+
+segmentation_batcher = MicroBatcher(
+    do_lung_segmentation_batch,
+    INFERENCE_EXECUTORS["segmentation"],
+    max_concurrent_batches=SEGMENTATION_WORKER_THREADS,
+)
 
 
 async def run_lung_segmentation_process(img: itk.Image, active_layer: int | None = None) -> itk.Image:
-    """Runs the lung segmentation in a separate process to avoid blocking the GIL.
+    """Runs the lung segmentation on the segmentation worker thread.
 
     Args:
         img: The ITK image object.
@@ -265,15 +546,19 @@ async def run_lung_segmentation_process(img: itk.Image, active_layer: int | None
     print(f"Layer/slice index `{active_layer}` chosen for segmentation...")
 
     slice_2d = get_image_slice(img, active_layer)
+    # Validate the input here, so that it cannot fail the batch it would share
+    # with other requests
+    slice_array = itk.array_view_from_image(slice_2d).squeeze()
+    if slice_array.ndim != 2:
+        raise ValueError(
+            f"Lung segmentation expects a 2D scalar image slice, got an array of shape {slice_array.shape}"
+        )
 
     # ==== Processing logic ====
-    serialized_img_vtkjs = convert_itk_to_vtkjs_image(slice_2d)
-    loop = asyncio.get_event_loop()
-
+    # The segmentation worker is a thread of this process, so only the pixel
+    # array is handed over; image metadata stays on this side.
     try:
-        serialized_output = await loop.run_in_executor(
-            process_pool, do_lung_segmentation, serialized_img_vtkjs
-        )
+        seg_array = await segmentation_batcher.submit(slice_array)
     except FileNotFoundError as e:
         raise RuntimeError(
             f"Lung segmentation failed due to missing model file: {e}"
@@ -282,25 +567,20 @@ async def run_lung_segmentation_process(img: itk.Image, active_layer: int | None
         raise RuntimeError(
             f"Unexpected error during lung segmentation: {e}"
         ) from e
-
-    processed_slice = convert_vtkjs_to_itk_image(serialized_output)
     # ==========================
 
-    # Determine where to paste
-    input_region = img.GetBufferedRegion()
-    start = list(input_region.GetIndex())
-    start[2] = active_layer  # Put slice back at the right Z
-
-    # If image was originally 3D, paste the processed slice back
+    # If image was originally 3D, write the processed slice back into its buffer.
+    # The image is a fresh copy from the client, so it can be modified in place.
     if img.GetImageDimension() == 3 and active_layer is not None:
-        paste_filter = itk.PasteImageFilter.New(img)
-        paste_filter.SetSourceImage(processed_slice)
-        paste_filter.SetDestinationImage(img)
-        paste_filter.SetDestinationIndex(start)
-        paste_filter.SetSourceRegion(processed_slice.GetBufferedRegion())
-        paste_filter.Update()
-        return paste_filter.GetOutput()
+        offset = active_layer - img.GetBufferedRegion().GetIndex()[2]
+        volume = itk.array_view_from_image(img)
+        volume[offset] = seg_array.reshape(volume.shape[1:])
+        return img
     else:
+        processed_slice = itk.image_view_from_array(seg_array.reshape(itk.array_view_from_image(slice_2d).shape))
+        processed_slice.SetOrigin(slice_2d.GetOrigin())
+        processed_slice.SetSpacing(slice_2d.GetSpacing())
+        processed_slice.SetDirection(slice_2d.GetDirection())
         return processed_slice
 
 
@@ -338,19 +618,22 @@ async def segment_lungs(img_id: str, active_layer: int | None = None) -> None:
     # processed image, we instead assume we are re-running
     # the operation on the original image.
     base_image_id = get_base_image(state, img_id)
-    img = await store.dataIndex[base_image_id]
+    seg_id = state.base_to_seg.get(base_image_id)
 
-    # we need to run the filter in a subprocess,
-    # since itk blocks the GIL.
+    # Fetch the image and check for an existing segmentation concurrently
+    if seg_id:
+        img, seg_exists_on_client_side = await asyncio.gather(
+            store.dataIndex[base_image_id], store.metadata[seg_id]
+        )
+    else:
+        img = await store.dataIndex[base_image_id]
+        seg_exists_on_client_side = None
+
+    # the segmentation runs on its worker thread,
+    # where the model stays loaded.
     segout = await run_lung_segmentation_process(img, active_layer)
     print(f"Completed segmentLungs on VolView \"images\" store image ID: {img_id}.")
 
-    seg_id = state.image_id_map.get(base_image_id)
-    seg_exists_on_client_side = None
-    if seg_id:
-        seg_exists_on_client_side = await store.metadata[seg_id]
-        # seg_exists_on_client_side = await store.dataIndex[seg_id]
-
     print('seg_exists_on_client_side: ', seg_exists_on_client_side)
 
     if seg_id and seg_exists_on_client_side:
@@ -1,4 +1,3 @@
-import itk
 import lightning as L
 from monai.networks.nets.unetr import UNETR
 from monai.transforms.compose import Compose
@@ -7,9 +6,21 @@ from monai.transforms.post.dictionary import Invertd
 from monai.transforms.spatial.dictionary import Resized
 from monai.transforms.utility.dictionary import EnsureChannelFirstd
 from monai.transforms.utility.dictionary import ToTensord
+import copy
+import importlib.util
 import numpy as np
+import os
+import threading
 import torch
 
+# Segmentation backend: "torch" (default) or "onnx", which exports the checkpoint
+# once and runs it through onnxruntime (requires the onnxruntime package).
+SEGMENTATION_BACKEND = os.getenv("SEGMENTATION_BACKEND", "torch").lower()
+# Set to 1 to optimize the PyTorch model at load: a frozen TorchScript graph with
+# Conv/BN folding and MKLDNN kernels on CPU, channels_last FP16 on GPU.
+SEGMENTATION_TORCH_OPTIMIZE = os.getenv("SEGMENTATION_TORCH_OPTIMIZE") == "1"
+ONNX_PROVIDERS = ["TensorrtExecutionProvider", "CUDAExecutionProvider", "CPUExecutionProvider"]
+
 class NetInference(L.LightningModule):
     def __init__(self, input_size, num_classes):
         super().__init__()
@@ -20,51 +31,158 @@ class NetInference(L.LightningModule):
         x = self.model(x)
         return x
     
-def run_volview_insight_seg_inference(itk_img: itk.image, model_checkpoint: str) -> itk.image:
-    input_img = itk.array_from_image(itk_img).astype(int).squeeze()
-    input_size = [512,512]
-    num_classes = 2
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    model = NetInference.load_from_checkpoint(model_checkpoint, input_size=input_size, num_classes=num_classes, strict=False, map_location=device)
-    model.eval() # Evaluation mode
+# Loaded models, keyed by checkpoint path. Loading is guarded by a lock so that
+# concurrent first requests do not load the same checkpoint twice.
+_models = {}
+_models_lock = threading.Lock()
+
+def load_seg_model(model_checkpoint: str) -> NetInference:
+    with _models_lock:
+        if model_checkpoint not in _models:
+            input_size = [512,512]
+            num_classes = 2
+            device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+            model = NetInference.load_from_checkpoint(model_checkpoint, input_size=input_size, num_classes=num_classes, strict=False, map_location=device)
+            model.eval() # Evaluation mode
+            _models[model_checkpoint] = model
+        return _models[model_checkpoint]
+
+# Models prepared for inference, keyed by checkpoint path
+_inference_models = {}
+
+def optimize_seg_model(model: NetInference) -> torch.nn.Module:
+    """Returns an inference-only version of a loaded model."""
+    if torch.cuda.is_available():
+        return copy.deepcopy(model).to(memory_format=torch.channels_last).half()
+    with torch.no_grad():
+        traced = torch.jit.trace(model, torch.zeros((1, 1, 512, 512), device=model.device))
+    return torch.jit.optimize_for_inference(traced)
+
+def load_seg_inference_model(model_checkpoint: str) -> torch.nn.Module:
+    """Loads the model used by the PyTorch backend, optimized if SEGMENTATION_TORCH_OPTIMIZE is set."""
+    model = load_seg_model(model_checkpoint)
+    if not SEGMENTATION_TORCH_OPTIMIZE:
+        return model
+    with _models_lock:
+        if model_checkpoint not in _inference_models:
+            _inference_models[model_checkpoint] = optimize_seg_model(model)
+        return _inference_models[model_checkpoint]
+
+# ONNX Runtime sessions, keyed by checkpoint path, and the locks serializing their
+# export and creation
+_onnx_sessions = {}
+_onnx_locks = {}
+
+def export_seg_onnx(model_checkpoint: str, onnx_path: str, use_fp16: bool) -> None:
+    """Exports a checkpoint to ONNX, through a temporary file so that an interrupted
+    export never leaves a truncated graph at `onnx_path`."""
+    model = load_seg_model(model_checkpoint)
+    dtype = torch.float16 if use_fp16 else torch.float32
+    dummy = torch.zeros((1, 1, 512, 512), dtype=dtype, device=model.device)
+    tmp_path = f"{onnx_path}.{os.getpid()}.tmp"
+    try:
+        # UNETR has a fixed input size, so only the batch axis is dynamic
+        # Export from a copy, so that the cached PyTorch model keeps its precision
+        torch.onnx.export(
+            copy.deepcopy(model).to(dtype),
+            dummy,
+            tmp_path,
+            opset_version=17,
+            input_names=["input"],
+            output_names=["logits"],
+            dynamic_axes={"input": {0: "N"}, "logits": {0: "N"}},
+        )
+        os.replace(tmp_path, onnx_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def load_seg_onnx_session(model_checkpoint: str):
+    """Loads an ONNX Runtime session for a checkpoint, exporting it next to the checkpoint on first use.
+
+    The exported graph is FP16 when onnxruntime has a GPU provider and FP32 otherwise. Its
+    file name includes the checkpoint's modification time, so a changed checkpoint is re-exported.
+    """
+    import onnxruntime as ort
+
+    with _models_lock:
+        if model_checkpoint in _onnx_sessions:
+            return _onnx_sessions[model_checkpoint]
+        lock = _onnx_locks.setdefault(model_checkpoint, threading.Lock())
 
-    assert len(input_img.shape) == 2, f"Expected input image of dimension 2, got: {len(input_img.shape)}"
+    with lock:
+        if model_checkpoint in _onnx_sessions:
+            return _onnx_sessions[model_checkpoint]
 
+        available_providers = ort.get_available_providers()
+        providers = [p for p in ONNX_PROVIDERS if p in available_providers]
+        use_fp16 = providers[0] != "CPUExecutionProvider"
+        checkpoint_mtime = int(os.path.getmtime(model_checkpoint))
+        onnx_path = f"{os.path.splitext(model_checkpoint)[0]}.{checkpoint_mtime}{'.fp16' if use_fp16 else ''}.onnx"
+        if not os.path.exists(onnx_path):
+            export_seg_onnx(model_checkpoint, onnx_path, use_fp16)
+
+        _onnx_sessions[model_checkpoint] = ort.InferenceSession(onnx_path, providers=providers)
+        return _onnx_sessions[model_checkpoint]
+
+def use_onnx_backend() -> bool:
+    if SEGMENTATION_BACKEND != "onnx":
+        return False
+    if importlib.util.find_spec("onnxruntime") is None:
+        print("SEGMENTATION_BACKEND=onnx requires onnxruntime, falling back to PyTorch")
+        return False
+    return True
+
+def preload_seg_model(model_checkpoint: str) -> None:
+    """Loads the model for the configured backend, so that the first request does not pay for it."""
+    if use_onnx_backend():
+        load_seg_onnx_session(model_checkpoint)
+    else:
+        load_seg_inference_model(model_checkpoint)
+
+def run_volview_insight_seg_inference_arrays(arrays: list, model_checkpoint: str) -> list:
+    """Segments a batch of 2D pixel arrays, returning one (1, H, W) unsigned short label array per input."""
     pre_transforms = Compose([EnsureChannelFirstd(keys = ["image"], channel_dim = 'no_channel'),
                             ToTensord(keys = ["image"]),
                             Resized(keys=['image'], spatial_size = (512,512), mode=("bilinear")),
                             NormalizeIntensityd(keys=['image'])])
 
-    input_dict = {}
-    input_dict["image"] = input_img
+    # Apply preprocessing, which resizes every image to the model input size
+    transform_dicts = []
+    for array in arrays:
+        input_img = array.astype(int).squeeze()
+        if input_img.ndim != 2:
+            raise ValueError(f"Expected input image of dimension 2, got: {input_img.ndim}")
+        transform_dicts.append(pre_transforms({"image": input_img}))
 
-    # Apply preprocessing
-    transform_dict = pre_transforms(input_dict)
-
-    # Run inference
-    if torch.cuda.is_available():
-        transform_img = transform_dict["image"][None].cuda() # Add in batch dimension
+    # Run inference on the stacked batch
+    transform_batch = torch.stack([transform_dict["image"].as_tensor() for transform_dict in transform_dicts])
+    if use_onnx_backend():
+        session = load_seg_onnx_session(model_checkpoint)
+        input_type = np.float16 if session.get_inputs()[0].type == "tensor(float16)" else np.float32
+        (logits,) = session.run(None, {"input": transform_batch.numpy().astype(input_type)})
+        pred = torch.from_numpy(logits)
     else:
-        transform_img = transform_dict["image"][None].cpu()
-
-    pred = model(transform_img)
+        model = load_seg_inference_model(model_checkpoint)
+        if torch.cuda.is_available():
+            transform_batch = transform_batch.cuda()
+            if SEGMENTATION_TORCH_OPTIMIZE:
+                transform_batch = transform_batch.to(memory_format=torch.channels_last).half()
+        with torch.no_grad():
+            pred = model(transform_batch).float()
 
     # Output segmentation
-    pred.softmax(dim = 1) # Convert to probability map
     pred = torch.argmax(pred, dim=1)
-    transform_dict["infer"] = pred
 
     # Invert resize
     post_trans = Invertd(keys = "infer", transform = pre_transforms, orig_keys = "image", nearest_interp = True)
-    output_dict = post_trans(transform_dict)
 
-    # Output segmentation
-    seg = output_dict["infer"].cpu().numpy()
-    seg = seg.astype(np.ushort)
-    PixelType = itk.ctype("unsigned short")
-    Dimension = 3
-    ImageType = itk.Image[PixelType, Dimension]
-    result = itk.image_from_array(seg, ttype=ImageType)
-    result.SetOrigin(itk_img.GetOrigin())
-    result.SetSpacing(itk_img.GetSpacing())
-    return result
+    results = []
+    for i, transform_dict in enumerate(transform_dicts):
+        transform_dict["infer"] = pred[i:i + 1]
+        output_dict = post_trans(transform_dict)
+
+        # Output segmentation
+        seg = output_dict["infer"].cpu().numpy()
+        results.append(seg.astype(np.ushort))
+    return results
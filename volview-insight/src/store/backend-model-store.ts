@@ -56,6 +56,14 @@ export const useBackendModelStore = defineStore('backend-model-store', {
       this.analysisOutput[id] = result;
     },
 
+    /**
+     * Appends a chunk of a streamed analysis result.
+     * @param chunk - The next part of the MedGemma model's output.
+     */
+    appendAnalysisResult(id: string, chunk: string) {
+      this.analysisOutput[id] = (this.analysisOutput[id] ?? '') + chunk;
+    },
+
     /**
      * Resets the entire analysis state to its initial values.
      */